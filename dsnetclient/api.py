@@ -1,11 +1,15 @@
 import asyncio
 import datetime
+import logging
+import time
 import uuid
 from asyncio import Task, AbstractEventLoop
-from typing import Awaitable, Callable, Tuple, List, Optional
+from functools import cached_property
+from random import uniform
+from typing import Awaitable, Callable, Dict, Tuple, List, Optional
 
 import databases
-from aiohttp import ClientSession, WSMsgType, ClientConnectorError
+from aiohttp import ClientSession, WSMsgType, ClientConnectorError, WSServerHandshakeError, TCPConnector, ClientTimeout
 from dsnet.core import Conversation, Query, QueryType
 from dsnet.crypto import gen_key_pair, get_public_key
 from dsnet.logger import logger
@@ -32,6 +36,37 @@ class InvalidAuthorizationResponse(Exception): pass
 
 
 EPOCH_DURATION_SECONDS = 30 * 24 * 3600
+HTTP_CONNECTIONS_PER_HOST = 32
+DNS_CACHE_SECONDS = 300
+HTTP_KEEPALIVE_SECONDS = 120
+HTTP_CONNECT_TIMEOUT_SECONDS = 5
+HTTP_TIMEOUT_SECONDS = 300
+TOKEN_SERVER_KEY_CACHE_SECONDS = 300
+
+
+def install_uvloop() -> bool:
+    """
+    use uvloop's event loop policy when it is installed (it is optional)
+    must be called before the loop is created (asyncio.run)
+    :return: True if uvloop is used
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    uvloop.install()
+    return True
+
+
+def http_session() -> ClientSession:
+    """
+    HTTP session keeping its connections alive, to be shared by the calls to the same servers.
+    It is bound to the current loop so it must be created from a coroutine.
+    """
+    return ClientSession(
+        connector=TCPConnector(limit_per_host=HTTP_CONNECTIONS_PER_HOST, ttl_dns_cache=DNS_CACHE_SECONDS,
+                               keepalive_timeout=HTTP_KEEPALIVE_SECONDS),
+        timeout=ClientTimeout(total=HTTP_TIMEOUT_SECONDS, sock_connect=HTTP_CONNECT_TIMEOUT_SECONDS))
 
 
 class DsnetApi:
@@ -45,24 +80,67 @@ class DsnetApi:
             message_sender: MessageSender,
             query_type: QueryType,
             reconnect_delay_seconds=2,
+            max_reconnect_delay_seconds=60,
+            heartbeat_seconds: Optional[float] = 20,
             index: Index = None,
+            session: Optional[ClientSession] = None,
     ) -> None:
         self.token_url = token_url
+        self._token_urls = {} if token_url is None else {
+            endpoint: token_url.join(URL(endpoint)) for endpoint in ('publickey', 'commitments', 'pretokens')
+        }
         self.repository = repository
         self.base_url = url
+        self._broadcast_url = url.join(URL('/bb/broadcast'))
+        self._notifications_url = url.join(URL('/notifications'))
         self.index = index
         self.secret_key = secret_key
         self.reconnect_delay_seconds = reconnect_delay_seconds
+        self.max_reconnect_delay_seconds = max_reconnect_delay_seconds
+        self.heartbeat_seconds = heartbeat_seconds
         self.stop = False
         self.ws = None
+        self._listen_task: Optional[Task] = None
+        self._closing: Optional[asyncio.Future] = None
         self.message_retriever = message_retriever
         self.message_sender = message_sender
         self.query_type = query_type
+        self._session = session
+        # a session given by the caller may be shared with other components: the caller closes it
+        self._owns_session = session is None
+        self._token_server_key_raw: Optional[bytes] = None
+        self._token_server_key: Optional[AbePublicKey] = None
+        self._token_server_key_ts = 0.0
+        self._token_server_key_lock: Optional[asyncio.Lock] = None
+        self._message_handlers: Dict[MessageType, Callable[[Message], Awaitable[None]]] = {
+            MessageType.NOTIFICATION: self.handle_ph_notification,
+            MessageType.QUERY: self.handle_query,
+            MessageType.PUBLICATION: self.handle_publication,
+        }
+
+    @property
+    def session(self) -> ClientSession:
+        """
+        HTTP session shared by all the calls to keep the connections alive.
+        It is created on first use so that it is bound to the running loop.
+        """
+        if self._session is None:
+            self._session = http_session()
+        return self._session
+
+    @cached_property
+    def public_key(self) -> bytes:
+        return get_public_key(self.secret_key)
+
+    async def __aenter__(self) -> 'DsnetApi':
+        return self
+
+    async def __aexit__(self, *_exc_info) -> None:
+        await self.close()
 
     async def get_server_version(self) -> dict:
-        async with ClientSession() as session:
-            async with session.get(self.base_url) as resp:
-                return await resp.json()
+        async with self.session.get(self.base_url) as resp:
+            return await resp.json()
 
     async def send_query(self, query: bytes) -> None:
         query_keys = gen_key_pair()
@@ -72,14 +150,19 @@ class DsnetApi:
 
         peers = await self.repository.peers()
         mspsi_key = None if self.query_type == QueryType.CLEARTEXT else MSPSIQuerier.gen_key()
-        for idx, peer in enumerate(peers):
-            conv = Conversation.create_from_querier(query_keys.secret, peer.public_key, query, query_mspsi_secret=mspsi_key)
-            await self.repository.save_conversation(conv)
-            if idx == len(peers) - 1:
-                query_msg = conv.create_query(abe_token)
-                async with ClientSession() as session:
-                    async with session.post(self.base_url.join(URL('/bb/broadcast')), data=query_msg.to_bytes()) as response:
-                        response.raise_for_status()
+        conversations = [
+            Conversation.create_from_querier(query_keys.secret, peer.public_key, query, query_mspsi_secret=mspsi_key)
+            for peer in peers
+        ]
+        if conversations:
+            query_msg = conversations[-1].create_query(abe_token)
+            # the pigeonholes must be committed before a reply can be notified
+            await self.repository.save_conversations(conversations)
+            await self._broadcast(query_msg.to_bytes())
+
+    async def _broadcast(self, payload: bytes) -> None:
+        async with self.session.post(self._broadcast_url, data=payload) as response:
+            response.raise_for_status()
 
     async def send_response(self, public_key: bytes, response_data: bytes) -> None:
         publications = await self.repository.get_publications()
@@ -87,9 +170,7 @@ class DsnetApi:
         conversation = Conversation.create_from_recipient(secret_key=self.secret_key, other_public_key=public_key, query_type=self.query_type, query_mspsi_secret=mspsi_key)
         response = conversation.create_response(response_data)
         await self.repository.save_conversation(conversation)
-        async with ClientSession() as session:
-            async with session.post(self.base_url.join(URL(f'/ph/{response.address.hex()}')), data=response.to_bytes()) as http_response:
-                http_response.raise_for_status()
+        await self.message_sender.send(response)
 
     async def send_message(self, conversation_id: int, message: bytes) -> None:
         conversation = await self.repository.get_conversation(conversation_id)
@@ -99,59 +180,80 @@ class DsnetApi:
 
     async def close(self):
         self.stop = True
+        if self._closing is not None and not self._closing.done(): self._closing.set_result(None)
         if self.ws is not None: await self.ws.close()
+        if self._owns_session and self._session is not None:
+            await self._session.close()
 
     async def start_listening(self, notification_cb: Callable[[Message], Awaitable[None]] = None,
                               decoder: Callable[[bytes], Message] = MessageType.loads):
         callback = self.websocket_callback if notification_cb is None else notification_cb
         last_message_ts = await self.broadcast_recovery_timestamp()
-        logger.info(f'Running datashare network client with query type {self.query_type.name} (timestamp: {last_message_ts})')
-        notification_url = '/notifications' if last_message_ts is None else f'/notifications?ts={last_message_ts.timestamp()}'
-        url_ws = self.base_url.join(URL(notification_url))
+        logger.info('Running datashare network client with query type %s (timestamp: %s)', self.query_type.name, last_message_ts)
+        url_ws = self._notifications_url if last_message_ts is None else \
+            self._notifications_url.with_query(ts=str(last_message_ts.timestamp()))
+        frame_decoders = {
+            WSMsgType.BINARY: decoder,
+            WSMsgType.TEXT: lambda data: decoder(data.encode()),
+        }
         nb_errors = 0
         nb_max_errors = 5
+        nb_failed_connections = 0
+        self._closing = asyncio.get_running_loop().create_future()
         while not self.stop:
             self.ws = None
             try:
-                async with ClientSession() as session:
-                    async with session.ws_connect(url_ws) as self.ws:
-                        logger.info(f"connected to websocket {url_ws}")
-                        async for msg in self.ws:
-                            if msg.type == WSMsgType.BINARY:
-                                await callback(decoder(msg.data))
-                            elif msg.type == WSMsgType.TEXT:
-                                await callback(decoder(msg.data.encode()))
-                            else:
-                                logger.warning(f"received unhandled type {msg.type}")
-            except ClientConnectorError:
-                logger.warning(f"ws connection lost waiting {self.reconnect_delay_seconds}s "
-                               f"before reconnect to {url_ws}")
-                await asyncio.sleep(self.reconnect_delay_seconds)
+                async with self.session.ws_connect(url_ws, heartbeat=self.heartbeat_seconds) as self.ws:
+                    nb_failed_connections = 0
+                    logger.info("connected to websocket %s", url_ws)
+                    get_decoder = frame_decoders.get
+                    async for msg in self.ws:
+                        decode = get_decoder(msg.type)
+                        if decode is None:
+                            logger.warning("received unhandled type %s", msg.type)
+                        else:
+                            await callback(decode(msg.data))
+            except (ClientConnectorError, WSServerHandshakeError, asyncio.TimeoutError):
+                delay = self.reconnect_delay(nb_failed_connections)
+                nb_failed_connections += 1
+                logger.warning("ws connection lost waiting %.1fs before reconnect to %s", delay, url_ws)
+                # woken up by close() so that it doesn't wait for the reconnection delay
+                await asyncio.wait([self._closing], timeout=delay)
             except Exception as e:
                 nb_errors += 1
                 logger.exception(e)
                 if nb_errors >= nb_max_errors:
                     raise e
 
+    def reconnect_delay(self, nb_failed_connections: int) -> float:
+        """
+        exponential backoff capped to max_reconnect_delay_seconds, with +/-25% jitter
+        so that clients disconnected together don't reconnect all at once
+        :param nb_failed_connections: number of consecutive failed connections
+        :return: delay in seconds
+        """
+        delay = min(self.reconnect_delay_seconds * 2 ** min(nb_failed_connections, 16), self.max_reconnect_delay_seconds)
+        return delay * uniform(0.75, 1.25)
+
     def background_listening(self, notification_cb: Callable[[Message], Awaitable[None]] = None,
                              decoder: Callable[[bytes], Message] = MessageType.loads,
                              loop: Optional[AbstractEventLoop] = None) -> Task:
-        evt_loop = asyncio.get_event_loop() if loop is None else loop
-        return evt_loop.create_task(self.start_listening(notification_cb, decoder))
+        listening = self.start_listening(notification_cb, decoder)
+        # the loop only keeps a weak reference to tasks: keep it alive even if the caller drops it
+        self._listen_task = asyncio.create_task(listening) if loop is None else loop.create_task(listening)
+        return self._listen_task
 
     async def websocket_callback(self, message: Message) -> None:
-        logger.debug(f"received message type {message.type()}")
-        if message.type() == MessageType.NOTIFICATION:
-            await self.handle_ph_notification(message)
-        elif message.type() == MessageType.QUERY:
-            await self.handle_query(message)
-        elif message.type() == MessageType.PUBLICATION:
-            await self.handle_publication(message)
+        message_type = message.type()
+        logger.debug("received message type %s", message_type)
+        handler = self._message_handlers.get(message_type)
+        if handler is None:
+            logger.warning("received unhandled type %s", message_type)
         else:
-            logger.warning(f"received unhandled type {message.type()}")
+            await handler(message)
 
     async def handle_ph_notification(self, msg: PigeonHoleNotification) -> None:
-        logger.debug(f"received ph notification for {msg.adr_hex}")
+        logger.debug("received ph notification for %s", msg.adr_hex)
         encoded_message_ph_tuple = await self.message_retriever.retrieve(msg)
 
         if encoded_message_ph_tuple is not None:
@@ -159,11 +261,12 @@ class DsnetApi:
 
             message = PigeonHoleMessage.from_bytes(encoded_message)
             message.from_key = ph.key_for_hash
-            logger.info(f"received message {MessageType(message.type()).__repr__()}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("received message %r", MessageType(message.type()))
 
             conversation = await self.repository.get_conversation_by_address(message.address)
             if message.type() == MessageType.RESPONSE:
-                payload = ph.decrypt(message.payload)
+                payload = await asyncio.get_running_loop().run_in_executor(None, ph.decrypt, message.payload)
                 results = await self.index.process_search_results(payload, conversation)
                 conversation.add_results(results, ph)
             else:
@@ -174,85 +277,122 @@ class DsnetApi:
             logger.debug("no message retrieved, ignoring")
 
     async def handle_query(self, msg: Query) -> None:
-        logger.info(f"received query {msg.public_key.hex()}")
-        server_key: AbePublicKey = await self.repository.get_token_server_key()
-        if msg.validate(server_key):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("received query %s", msg.public_key.hex())
+        server_key = await self.get_token_server_key()
+        valid = await asyncio.get_running_loop().run_in_executor(None, msg.validate, server_key)
+        if valid:
             results = await self.index.search(msg.payload)
             if results is not None:
                 await self.send_response(msg.public_key, results)
         else:
-            logger.warning(f"invalid query's signature {msg.public_key.hex()}")
+            logger.warning("invalid query's signature %s", msg.public_key.hex())
+
+    async def get_token_server_key(self) -> Optional[AbePublicKey]:
+        """
+        token server key from the repository, kept in memory for TOKEN_SERVER_KEY_CACHE_SECONDS
+        as it is read for each received query and rarely changes
+        """
+        if self._token_server_key_is_fresh():
+            return self._token_server_key
+        if self._token_server_key_lock is None:
+            self._token_server_key_lock = asyncio.Lock()
+        # a burst of queries after expiry triggers only one repository read
+        async with self._token_server_key_lock:
+            if not self._token_server_key_is_fresh():
+                self._token_server_key = await self.repository.get_token_server_key()
+                self._token_server_key_ts = time.monotonic()
+        return self._token_server_key
+
+    def _token_server_key_is_fresh(self) -> bool:
+        return self._token_server_key is not None and \
+            time.monotonic() - self._token_server_key_ts <= TOKEN_SERVER_KEY_CACHE_SECONDS
 
     async def handle_publication(self, msg: PublicationMessage):
-        logger.info(f"received publication {msg.public_key.hex()}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("received publication %s", msg.public_key.hex())
         await self.repository.save_publication_message(msg)
 
     async def show_tokens(self) -> List[bytes]:
-        return [packb(abe_token.token) for abe_token in await self.repository.get_tokens()]
+        return await self.repository.get_packed_tokens()
 
     async def fetch_pre_tokens(self, username: str, password: str, form_parser: Callable[[bytes, str, str], Tuple[str, dict]]) -> int:
-        async with ClientSession() as session:
-            publickey_resp = await session.get(self.token_url.join(URL('publickey')))
-            server_public_key_raw = await publickey_resp.content.read()
-            local_key = await self.repository.get_token_server_key()
+        # the session is a shared pool: every response is released, including on error paths
+        session = self.session
+
+        async def read_server_public_key() -> bytes:
+            async with session.get(self._token_urls['publickey']) as publickey_resp:
+                return await publickey_resp.content.read()
 
-            server_key: AbePublicKey = unpackb(server_public_key_raw)
-            if server_key != local_key:
-                commitments_resp = await session.post(self.token_url.join(URL('commitments')))
+        server_public_key_raw, local_key = await asyncio.gather(read_server_public_key(), self.get_token_server_key())
+        if server_public_key_raw == self._token_server_key_raw:
+            return 0
 
+        server_key: AbePublicKey = unpackb(server_public_key_raw)
+        if server_key != local_key:
+            async with session.post(self._token_urls['commitments']) as commitments_resp:
                 content_type = commitments_resp.headers.get("Content-Type")
-                if content_type != "application/x-msgpack":
-                    if "text/html" not in content_type or username is None or password is None:
-                        raise InvalidAuthorizationResponse()
+                if content_type == "application/x-msgpack":
+                    commitments_raw = await commitments_resp.content.read()
+                elif "text/html" not in content_type or username is None or password is None:
+                    raise InvalidAuthorizationResponse()
+                else:
+                    commitments_raw = None
                     html_content = await commitments_resp.content.read()
-                    url_str, parameters = form_parser(html_content, username, password)
-                    if url_str is None:
-                        url = commitments_resp.url
-                    else:
-                        url = commitments_resp.url.join(URL(url_str))
+                    commitments_url = commitments_resp.url
 
-                    oauth2_resp = await session.post(url, data=parameters)
+            if commitments_raw is None:
+                url_str, parameters = form_parser(html_content, username, password)
+                url = commitments_url if url_str is None else commitments_url.join(URL(url_str))
 
+                async with session.post(url, data=parameters) as oauth2_resp:
                     if oauth2_resp.status != 200:
                         raise InvalidAuthorizationResponse()
 
-                    commitments_resp = await session.post(self.token_url.join(URL('commitments')))
-
+                async with session.post(self._token_urls['commitments']) as commitments_resp:
                     if commitments_resp.headers.get("Content-Type") != 'application/x-msgpack':
                         raise InvalidAuthorizationResponse()
+                    commitments_raw = await commitments_resp.content.read()
 
-                commitments: List[SignerCommitMessage] = unpackb(await commitments_resp.content.read())
+            commitments: List[SignerCommitMessage] = unpackb(commitments_raw)
 
-                challenges, challenges_internal, token_secret_keys = generate_challenges(server_key, commitments)
+            loop = asyncio.get_running_loop()
+            challenges, challenges_internal, token_secret_keys = await loop.run_in_executor(
+                None, generate_challenges, server_key, commitments)
 
-                pretoken_resp = await session.post(
-                    self.token_url.join(URL('pretokens')),
-                    headers={'Content-Type': 'application/x-msgpack'},
-                    data=packb(challenges)
-                )
+            async with session.post(
+                self._token_urls['pretokens'],
+                headers={'Content-Type': 'application/x-msgpack'},
+                data=packb(challenges)
+            ) as pretoken_resp:
                 pretokens: List[SignerResponseMessage] = unpackb(await pretoken_resp.content.read())
-                tokens = generate_tokens(server_key, challenges_internal, token_secret_keys, pretokens)
+            tokens = await loop.run_in_executor(
+                None, generate_tokens, server_key, challenges_internal, token_secret_keys, pretokens)
 
-                # bulk insert tokens in DB
+            # bulk insert tokens in DB
+            async with self.repository.transaction():
                 await self.repository.save_token_server_key(server_key)
                 await self.repository.save_tokens(tokens)
+            self._token_server_key_raw = server_public_key_raw
+            self._token_server_key = server_key
+            self._token_server_key_ts = time.monotonic()
 
-                return len(tokens)
+            return len(tokens)
+        self._token_server_key_raw = server_public_key_raw
         return 0
 
     async def send_publication(self):
-        n_hits, generator = await self.index.publish()
-        documents = await self.index.get_documents()
-        secret, publication = MSPSIDocumentOwner.publish(generator, documents, n_hits)
+        (n_hits, generator), documents = await asyncio.gather(self.index.publish(), self.index.get_documents())
+        nb_documents = len(documents)
+        secret, publication = await asyncio.get_running_loop().run_in_executor(
+            None, MSPSIDocumentOwner.publish, generator, documents, n_hits)
 
         nym = await self.get_or_create_nym()
 
-        payload = PublicationMessage(nym, get_public_key(self.secret_key), publication, len(documents)).to_bytes()
-        async with ClientSession() as session:
-            async with session.post(self.base_url.join(URL('/bb/broadcast')), data=payload) as response:
-                response.raise_for_status()
+        payload = PublicationMessage(nym, self.public_key, publication, nb_documents).to_bytes()
+        await self._broadcast(payload)
 
-        await self.repository.save_publication(Publication(self.secret_key, secret, nym, len(documents)))
+        await self.repository.save_publication(Publication(self.secret_key, secret, nym, nb_documents))
 
     async def get_or_create_nym(self):
         nym = await self.repository.get_parameter("nym")
@@ -285,11 +425,12 @@ def main():
             NamedEntity("doc_id", NamedEntityCategory.PERSON, "bar"),
         ], documents=[Document("doc_id", datetime.datetime.utcnow(), "content with foo bar")]),
         query_type=QueryType.CLEARTEXT,
-        message_retriever=AddressMatchMessageRetriever(URL(dburl), repository),
-        message_sender=DirectMessageSender(URL(dburl)),
+        message_retriever=AddressMatchMessageRetriever(url, repository),
+        message_sender=DirectMessageSender(url),
     )
 
-    asyncio.get_event_loop().run_until_complete(api.start_listening())
+    install_uvloop()
+    asyncio.run(api.start_listening())
 
 
 if __name__ == '__main__':
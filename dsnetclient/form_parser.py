@@ -1,21 +1,20 @@
 from typing import Tuple
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import builder_registry
 
+# lxml is optional: it parses much faster than the pure python html.parser when installed
+HTML_PARSER = "lxml" if builder_registry.lookup("lxml") is not None else "html.parser"
+FORMS_ONLY = SoupStrainer("form")
+LOGIN_INPUTS = 'input[type=hidden][name][value], input[type=password][name], input[type=text][name^=user]'
 
-def bs_parser(html: bytes, username: str, password: str) -> Tuple[str, dict]:
-    parameters = dict()
-    soup = BeautifulSoup(html, features="html.parser")
-    forms = soup.find_all("form")
-    form_url = forms[0].attrs.get('action')
-    inputs = forms[0].find_all("input")
-
-    for input in inputs:
-        if input.attrs["type"] == "hidden" and 'name' in input.attrs and 'value' in input.attrs:
-            parameters[input.attrs['name']] = input.attrs['value']
-        elif input.attrs["type"] == "password":
-            parameters[input.attrs["name"]] = password
-        elif input.attrs["type"] == "text" and input.attrs['name'].startswith('user'):
-            parameters[input.attrs["name"]] = username
-    return form_url, parameters
 
+def bs_parser(html: bytes, username: str, password: str) -> Tuple[str, dict]:
+    soup = BeautifulSoup(html, features=HTML_PARSER, parse_only=FORMS_ONLY)
+    form = soup.form
+    user_values = {"password": password, "text": username}
+    parameters = {
+        input.attrs["name"]: user_values.get(input.attrs["type"].lower(), input.attrs.get("value"))
+        for input in form.select(LOGIN_INPUTS)
+    }
+    return form.attrs.get('action'), parameters
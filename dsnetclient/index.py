@@ -1,14 +1,21 @@
 import abc
+import asyncio
 from json import dumps
 from typing import List, Tuple, Iterator, Optional
 
 from dsnet.core import Conversation
 from dsnet.mspsi import Document, NamedEntity, NamedEntityCategory, MSPSIDocumentOwner, MSPSIQuerier
 from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_scan
 from sscred import unpackb, packb
 
 from dsnetclient.repository import Repository
 
+PUBLISH_PAGE_SIZE = 1000
+CATEGORY_BY_NAME = dict(NamedEntityCategory.__members__)
+SEARCH_FILTER_PATH = "hits.hits._source.mention"
+DOCUMENTS_FILTER_PATH = "hits.hits._id,hits.hits._source.extractionDate"
+
 
 class Index(metaclass=abc.ABCMeta):
     """
@@ -56,7 +63,38 @@ class Index(metaclass=abc.ABCMeta):
 
 
 class LuceneIndex(Index):
+    # built once, shared by all get_documents calls: it must not be mutated
+    DOCUMENTS_BODY = {
+        "size": 10000,
+        "track_total_hits": False,
+        "_source": ["extractionDate"],
+        "query": {
+            "bool": {
+                "filter": [
+                    {
+                        "term": {
+                            "type": "Document"
+                        }
+                    },
+                    {
+                        "has_child": {
+                            "type": "NamedEntity",
+                            "query": {
+                                "match_all": {}
+                            }
+                        }
+                    }
+                ]
+            }
+        },
+    }
+
     def __init__(self, aes: AsyncElasticsearch, index_name: str = "local-datashare"):
+        """
+        :param aes: elasticsearch client, preferably created with http_compress=True
+        as search responses are large and very compressible JSON
+        :param index_name: datashare index
+        """
         self.index_name = index_name
         self.aes = aes
 
@@ -65,71 +103,64 @@ class LuceneIndex(Index):
 
     async def get_documents(self) -> List[Document]:
         body = self.query_documents_body()
-        resp = await self.aes.search(index=self.index_name, **body)
+        resp = await self.aes.search(index=self.index_name, filter_path=DOCUMENTS_FILTER_PATH, **body)
         return [
-            Document(hit["_id"], hit["_source"]["extractionDate"]) for hit in resp["hits"]["hits"]
+            Document(hit["_id"], hit["_source"]["extractionDate"]) for hit in self.hits(resp)
         ]
 
     async def publish(self) -> Tuple[int, Iterator[NamedEntity]]:
-        body = self.query_body_from_string("*")
-        resp = await self.aes.search(index=self.index_name, **body)
-        return resp["hits"]["total"]["value"], (NamedEntity(
-            hit["_routing"],
-            NamedEntityCategory[hit["_source"]["category"]],
-            hit["_source"]["mention"]
-        ) for hit in resp["hits"]["hits"])
+        # scrolls through all the named entities as a single search is capped to 10000 hits
+        query = {"_source": ["category", "mention"], "query": self.named_entities_query("*")}
+        hits = async_scan(self.aes, index=self.index_name, query=query, size=PUBLISH_PAGE_SIZE)
+        named_entities = []
+        append = named_entities.append
+        async for hit in hits:
+            source = hit["_source"]
+            append(NamedEntity(hit["_routing"], CATEGORY_BY_NAME[source["category"]], source["mention"]))
+        return len(named_entities), iter(named_entities)
 
     async def search(self, kwds_packb: bytes) -> bytes:
         query = b' '.join(unpackb(kwds_packb))
         body = self.query_body_from_string(query.decode())
-        resp = await self.aes.search(index=self.index_name, **body)
-        return packb([hit["_source"]["mention"] for hit in resp["hits"]["hits"]])
+        resp = await self.aes.search(index=self.index_name, filter_path=SEARCH_FILTER_PATH, **body)
+        return packb([hit["_source"]["mention"] for hit in self.hits(resp)])
+
+    @staticmethod
+    def hits(resp: dict) -> List[dict]:
+        # with filter_path, elasticsearch returns an empty object when there is no hit
+        return resp.get("hits", {}).get("hits", [])
 
     def query_body_from_string(self, query: str) -> dict:
         return {
             "size": 10000,
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "match": {
-                                "type": "NamedEntity"
-                            }
-                        },
-                        {
-                            "query_string": {
-                                "query": query
-                            }
-                        }
-                    ]
-                }
-            }
+            "track_total_hits": False,
+            "_source": ["mention"],
+            "query": self.named_entities_query(query)
         }
 
-    def query_documents_body(self) -> dict:
+    def named_entities_query(self, query: str) -> dict:
         return {
-            "size": 10000,
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "match": {
-                                "type": "Document"
-                            }
-                        },
-                        {
-                            "has_child": {
-                                "type": "NamedEntity",
-                                "query": {
-                                    "match_all": {}
-                                }
-                            }
+            "bool": {
+                "filter": [
+                    {
+                        "term": {
+                            "type": "NamedEntity"
+                        }
+                    }
+                ],
+                "must": [
+                    {
+                        "query_string": {
+                            "query": query
                         }
-                    ]
-                }
-            },
+                    }
+                ]
+            }
         }
 
+    def query_documents_body(self) -> dict:
+        return self.DOCUMENTS_BODY
+
     async def close(self):
         await self.aes.close()
 
@@ -138,6 +169,7 @@ class MemoryIndex(Index):
     def __init__(self, entities: List[NamedEntity], documents: List[Document]):
         self.entities = entities
         self.documents = documents
+        self._mentions = frozenset(e.mention for e in entities)
 
     async def process_search_results(self, results: bytes, _c: Conversation) -> bytes:
         return results
@@ -146,9 +178,8 @@ class MemoryIndex(Index):
         return len(self.entities), iter(self.entities)
 
     async def search(self, query: bytes) -> bytes:
-        term_list = set(query.decode().split())
-        entities = set((e.mention for e in self.entities))
-        return dumps(list(term_list.intersection(entities))).encode()
+        terms = dict.fromkeys(query.decode().split())
+        return dumps([term for term in terms if term in self._mentions]).encode()
 
     async def get_documents(self) -> List[Document]:
         return self.documents
@@ -164,9 +195,12 @@ class MspsiIndex(Index):
 
     async def process_search_results(self, raw_response: bytes, conversation: Conversation) -> bytes:
         kwds_enc: List[bytes] = unpackb(raw_response)
-        kwds_dec = MSPSIQuerier.decode_reply(conversation.query_mspsi_secret, kwds_enc)
-        publication_message = await self.repository.get_publication_message(conversation.other_public_key)
-        kwds_per_docs = MSPSIQuerier.process_reply(
+        loop = asyncio.get_running_loop()
+        kwds_dec, publication_message = await asyncio.gather(
+            loop.run_in_executor(None, MSPSIQuerier.decode_reply, conversation.query_mspsi_secret, kwds_enc),
+            self.repository.get_publication_message(conversation.other_public_key))
+        kwds_per_docs = await loop.run_in_executor(
+            None, MSPSIQuerier.process_reply,
             kwds_dec, publication_message.num_documents, publication_message.cuckoo_filter)
         return dumps(kwds_per_docs).encode()
 
@@ -176,7 +210,11 @@ class MspsiIndex(Index):
     async def search(self, query: bytes) -> Optional[bytes]:
         kwds = unpackb(query)
         publications = await self.repository.get_publications()
-        return packb(MSPSIDocumentOwner.reply(publications[0].secret, kwds)) if publications else None
+        if not publications:
+            return None
+        reply = await asyncio.get_running_loop().run_in_executor(
+            None, MSPSIDocumentOwner.reply, publications[0].secret, kwds)
+        return packb(reply)
 
     async def get_documents(self) -> List[Document]:
         return await self.es_index.get_documents()
@@ -6,7 +6,7 @@ import sys
 from getpass import getpass
 from pathlib import Path
 from random import expovariate, getrandbits
-from typing import List
+from typing import Dict, List, Optional
 
 import alembic
 from aioconsole import AsynchronousCli, ainput
@@ -24,7 +24,7 @@ from elasticsearch import AsyncElasticsearch
 from yarl import URL
 
 from dsnetclient import __version__
-from dsnetclient.api import DsnetApi, InvalidAuthorizationResponse
+from dsnetclient.api import DsnetApi, InvalidAuthorizationResponse, http_session, install_uvloop
 from dsnetclient.index import Index, LuceneIndex, MspsiIndex
 from dsnetclient.message_retriever import AddressMatchMessageRetriever, ProbabilisticCoverMessageRetriever
 from dsnetclient.message_sender import DirectMessageSender, QueueMessageSender
@@ -32,13 +32,16 @@ from dsnetclient.mutually_exclusive_click import MutuallyExclusiveOption
 from dsnetclient.repository import SqlalchemyRepository, Peer, Repository
 
 PARAM_EXTRACTOR = re.compile(r':param ([a-z_]+)')
+ELASTICSEARCH_CONNECTIONS = 32
 
 
 class Demo(AsynchronousCli):
-    def __init__(self, server_url: URL, token_url: URL, private_key: str, repository: Repository, keys: List[str], index: Index,
-                 query_type: QueryType, message_retriever, message_sender, loop):
-        super().__init__({method.replace('do_', ''): (getattr(self, method), get_arg_parser(self, method))
-                          for method in dir(self) if method.startswith('do_')}, prog='datashare network', loop=loop)
+    _command_parsers: Optional[Dict[str, argparse.ArgumentParser]] = None
+
+    def __init__(self, server_url: URL, token_url: URL, private_key: str, repository: Repository, keys: List[bytes], index: Index,
+                 query_type: QueryType, message_retriever, message_sender, loop, session: Optional[ClientSession] = None):
+        super().__init__({command: (getattr(self, f'do_{command}'), parser)
+                          for command, parser in self.command_parsers().items()}, prog='datashare network', loop=loop)
         self.private_key = bytes.fromhex(private_key)
         self.public_key = get_public_key(self.private_key)
         self.repository = repository
@@ -50,16 +53,23 @@ class Demo(AsynchronousCli):
             message_sender=message_sender,
             query_type=query_type,
             secret_key=self.private_key,
-            index=index
+            index=index,
+            session=session
         )
         self._listener = self.api.background_listening(loop=self.loop)  
         add_stdout_handler(level=logging.DEBUG)
         sys.ps1 = f'ds@{self.public_key[0:4].hex()}> '
-        for key_hex in keys:
-            key = bytes.fromhex(key_hex)
-            if private_key != self.public_key:
-                loop.run_until_complete(self.repository.save_peer(Peer(key)))
+        loop.run_until_complete(self.repository.save_peers([Peer(key) for key in keys]))
 
+    @classmethod
+    def command_parsers(cls) -> Dict[str, argparse.ArgumentParser]:
+        """
+        argument parsers of the do_ commands, built from their docstrings once per class
+        """
+        if cls.__dict__.get('_command_parsers') is None:
+            cls._command_parsers = {method[len('do_'):]: get_arg_parser(cls, method)
+                                    for method in dir(cls) if method.startswith('do_')}
+        return cls._command_parsers
 
     async def do_version(self, _reader, _writer) -> str:
         """
@@ -93,48 +103,43 @@ class Demo(AsynchronousCli):
         show tokens from the local repository.
         """
         tokens = await self.api.show_tokens()
-        return '\n'.join([f"{i+1:02}: [32:64] {token.hex()[32:64]} {len(token)}" for i, token in enumerate(tokens)])
+        return '\n'.join(f"{i+1:02}: [32:64] {token.hex()[32:64]} {len(token)}" for i, token in enumerate(tokens))
 
     async def do_queries(self, _reader, _writer) -> str:
         """
         list the queries sent or received (i.e. conversations)
         """
-        ret = list()
         conversations = await self.api.repository.get_conversations()
-        for conversation in conversations:
-            query = conversation.query.decode() if conversation.query else ""
-            ret.append(f"{conversation.id}: {query} for {conversation.other_public_key.hex()} "
-                       f"(sent: {conversation.nb_sent_messages}/recv: {conversation.nb_recv_messages})")
-        return '\n'.join(ret)
+        return '\n'.join(f"{conversation.id}: {(conversation.query or b'').decode()} for {conversation.other_public_key.hex()} "
+                         f"(sent: {conversation.nb_sent_messages}/recv: {conversation.nb_recv_messages})"
+                         for conversation in conversations)
 
     async def do_phs(self, _reader, _writer) -> str:
         """
         list the waiting pigeon holes
         """
         phs = await self.api.repository.get_pigeonholes()
-        return '\n'.join([f"{ph.address.hex() if ph.address else ''}: nb msg ({ph.message_number}) (conversation id={ph.conversation_id})" for ph in phs])
+        return '\n'.join(f"{ph.address.hex() if ph.address else ''}: nb msg ({ph.message_number}) (conversation id={ph.conversation_id})" for ph in phs)
 
     async def do_peers(self, _reader, _writer) -> str:
         """
         list the peers keys
         """
         peers = await self.api.repository.peers()
-        return '\n'.join([f"{peer.id}: {peer.public_key.hex()} {'(me)' if self.public_key == peer.public_key else ''}" for peer in peers])
+        return '\n'.join(f"{peer.id}: {peer.public_key.hex()} {'(me)' if self.public_key == peer.public_key else ''}" for peer in peers)
 
     async def do_messages(self, _reader, _writer, id) -> str:
         """
         list the messages related to a conversation
         :param id: conversation id
         """
-        conv = await self.api.repository.get_conversation(int(id))
-        ret = list()
-        if conv is not None:
-            for msg in conv._messages:
-                address = msg.address.hex() if msg.address is not None else 'query'
-                ret.append(f"{address} ({msg.timestamp}): {msg.payload} from {msg.from_key.hex()}")
-        else:
+        messages = await self.api.repository.get_messages(int(id))
+        if messages is None:
             return 'no such conversation id'
-        return '\n'.join(ret)
+        if not messages:
+            return 'no messages'
+        return '\n'.join(f"{msg.address.hex() if msg.address is not None else 'query'} ({msg.timestamp}): "
+                         f"{msg.payload} from {msg.from_key.hex()}" for msg in messages)
 
     async def do_message(self, _reader, _writer, conversation_id, message) -> None:
         """
@@ -224,10 +229,13 @@ def extract_arg_from_docstring(docstring: str) -> List[str]:
     return PARAM_EXTRACTOR.findall(docstring)
 
 
-async def get_server_config(server_url: URL) -> dict:
-    async with ClientSession() as session:
-        async with session.get(server_url) as resp:
-            return await resp.json()
+async def create_http_session() -> ClientSession:
+    return http_session()
+
+
+async def get_server_config(session: ClientSession, server_url: URL) -> dict:
+    async with session.get(server_url) as resp:
+        return await resp.json()
 
 
 @cli.command()
@@ -244,42 +252,53 @@ def shell(server_url, token_server_url, private_key, database_url, elasticsearch
         private_key_content = f.read()
 
     with open(keys, "r") as f:
-        keys_list = f.readlines()
+        keys_list = [bytes.fromhex(line.strip()) for line in f if line.strip()]
 
-    repository = SqlalchemyRepository(databases.Database(database_url))
-
-    if cover:
-        message_sender = QueueMessageSender(
-            URL(server_url), lambda: expovariate(0.2)
-        )
-        message_retriever = ProbabilisticCoverMessageRetriever(
-            URL(server_url), repository, lambda: bool(getrandbits(1))
-        )
-    else:
-        message_sender = DirectMessageSender(server_url)
-        message_retriever = AddressMatchMessageRetriever(server_url, repository)
+    database = databases.Database(database_url)
+    repository = SqlalchemyRepository(database)
 
+    install_uvloop()
     loop = asyncio.new_event_loop()
-    config = loop.run_until_complete(get_server_config(URL(server_url)))
-    query_type = QueryType(config['query_type'])
-
-    index = LuceneIndex(AsyncElasticsearch(elasticsearch_url), elasticsearch_index)
-    if query_type == QueryType.DPSI:
-        index = MspsiIndex(repository, index)
-
-    demo = Demo(
-        URL(server_url),
-        URL(token_server_url),
-        private_key_content,
-        repository,
-        keys_list,
-        index,
-        query_type,
-        message_retriever=message_retriever,
-        message_sender=message_sender,
-        loop=loop
-    )
-    loop.run_until_complete(demo.interact())
+    # one session for the whole shell (api, sender, retriever) so the server connections are reused
+    session = loop.run_until_complete(create_http_session())
+    # closed even if the startup fails, e.g. when the server is down
+    try:
+        if cover:
+            message_sender = QueueMessageSender(
+                URL(server_url), lambda: expovariate(0.2), event_loop=loop, session=session
+            )
+            message_retriever = ProbabilisticCoverMessageRetriever(
+                URL(server_url), repository, lambda: bool(getrandbits(1)), session=session
+            )
+        else:
+            message_sender = DirectMessageSender(URL(server_url), session)
+            message_retriever = AddressMatchMessageRetriever(URL(server_url), repository, session)
+
+        loop.run_until_complete(database.connect())
+        config = loop.run_until_complete(get_server_config(session, URL(server_url)))
+        query_type = QueryType(config['query_type'])
+
+        index = LuceneIndex(AsyncElasticsearch(elasticsearch_url, maxsize=ELASTICSEARCH_CONNECTIONS, http_compress=True), elasticsearch_index)
+        if query_type == QueryType.DPSI:
+            index = MspsiIndex(repository, index)
+
+        demo = Demo(
+            URL(server_url),
+            URL(token_server_url),
+            private_key_content,
+            repository,
+            keys_list,
+            index,
+            query_type,
+            message_retriever=message_retriever,
+            message_sender=message_sender,
+            loop=loop,
+            session=session
+        )
+        loop.run_until_complete(demo.interact())
+    finally:
+        loop.run_until_complete(session.close())
+        loop.run_until_complete(database.disconnect())
 
 
 if __name__ == '__main__':
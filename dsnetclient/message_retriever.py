@@ -20,18 +20,27 @@ class MessageRetriever(ABC):
 
 
 class AddressMatchMessageRetriever(MessageRetriever):
-    def __init__(self, url: URL, repository: Repository) -> None:
+    def __init__(self, url: URL, repository: Repository, session: Optional[ClientSession] = None) -> None:
         self.base_url = url
+        self._ph_url = url.join(URL('/ph/'))
         self.repository = repository
+        self.session = session
 
     async def retrieve(self, msg: PigeonHoleNotification) -> Optional[Tuple[bytes, PigeonHole]]:
-        async with ClientSession() as session:
-            addrs = await self.repository.get_pigeonholes_by_adr(msg.adr_hex)
-            for ph in addrs:
-                logger.debug("Try to retrieve message matching shortened %s", ph.address.hex())
-                async with session.get(self.base_url.join(URL(f'/ph/{ph.address.hex()}'))) as http_response:
-                    http_response.raise_for_status()
-                    return await http_response.read(), ph
+        addrs = await self.repository.get_pigeonholes_by_adr(msg.adr_hex)
+        if not addrs:
+            return None
+        if self.session is None:
+            async with ClientSession() as session:
+                return await self._get(session, addrs[0])
+        return await self._get(self.session, addrs[0])
+
+    async def _get(self, session: ClientSession, ph: PigeonHole) -> Tuple[bytes, PigeonHole]:
+        address_hex = ph.address.hex()
+        logger.debug("Try to retrieve message matching shortened %s", address_hex)
+        async with session.get(self._ph_url / address_hex) as http_response:
+            http_response.raise_for_status()
+            return await http_response.read(), ph
 
 
 class ProbabilisticCoverMessageRetriever(MessageRetriever):
@@ -43,6 +52,7 @@ class ProbabilisticCoverMessageRetriever(MessageRetriever):
             session: Optional[ClientSession] = None
             ) -> None:
         self.base_url = url
+        self._ph_url = url.join(URL('/ph/'))
         self.repository = repository
         self.session = ClientSession(timeout=ClientTimeout(total=60)) if session is None else session
         self.retrieve_decision_fn = retrieve_decision_fn
@@ -51,7 +61,7 @@ class ProbabilisticCoverMessageRetriever(MessageRetriever):
         pigeonholes = await self.repository.get_pigeonholes_by_adr(msg.adr_hex)
         if len(pigeonholes) > 0:
             pigeonholes_by_address = {ph.address: ph for ph in pigeonholes}
-            async with self.session.get(self.base_url.join(URL(f'/ph/{msg.adr_hex}'))) as http_response:
+            async with self.session.get(self._ph_url / msg.adr_hex) as http_response:
                 http_response.raise_for_status()
                 for message_b in msgpack.unpackb(await http_response.read()):
                     message = PigeonHoleMessage.from_bytes(message_b)
@@ -60,5 +70,5 @@ class ProbabilisticCoverMessageRetriever(MessageRetriever):
                         message.from_key = ph.key_for_hash
                         return message_b, ph
         elif self.retrieve_decision_fn():
-            async with self.session.get(self.base_url.join(URL(f'/ph/{msg.adr_hex}'))):
+            async with self.session.get(self._ph_url / msg.adr_hex):
                 pass
@@ -1,7 +1,7 @@
 import asyncio
 from abc import ABC, abstractmethod
 from asyncio import Queue, AbstractEventLoop
-from typing import Awaitable, Callable
+from typing import Awaitable, Callable, Optional
 
 from dsnet.core import PH_MESSAGE_LENGTH
 from dsnet.crypto import gen_fake_encrypted_message, gen_fake_address
@@ -11,6 +11,20 @@ from yarl import URL
 from dsnet.message import PigeonHoleMessage
 
 
+def message_url(ph_url: URL, message: PigeonHoleMessage) -> URL:
+    """pigeon hole url of the message: the hex address is already url safe, so it is appended without re-quoting"""
+    return ph_url.with_path(ph_url.raw_path + message.address.hex(), encoded=True)
+
+
+async def post_message(ph_url: URL, message: PigeonHoleMessage, session: Optional[ClientSession] = None) -> None:
+    """POST the message to its pigeon hole, with a one-off session when no shared session is given"""
+    if session is None:
+        async with ClientSession() as own_session:
+            return await post_message(ph_url, message, own_session)
+    async with session.post(message_url(ph_url, message), data=message.to_bytes()) as http_response:
+        http_response.raise_for_status()
+
+
 class MessageSender(ABC):
     """Message sender"""
 
@@ -22,13 +36,13 @@ class MessageSender(ABC):
 class DirectMessageSender(MessageSender):
     """Message sender which sends messages immediately."""
 
-    def __init__(self, base_url):
+    def __init__(self, base_url, session: Optional[ClientSession] = None):
         self.base_url = base_url
+        self._ph_url = base_url.join(URL('/ph/'))
+        self.session = session
 
     async def send(self, message: PigeonHoleMessage) -> None:
-        async with ClientSession() as session:
-            async with session.post(self.base_url.join(URL(f'/ph/{message.address.hex()}')), data=message.to_bytes()) as http_response:
-                http_response.raise_for_status()
+        await post_message(self._ph_url, message, self.session)
 
 
 class QueueMessageSender(MessageSender):
@@ -41,9 +55,12 @@ class QueueMessageSender(MessageSender):
     def __init__(self, base_url, distribution_fn: Callable[[], float],
                  send_fn: Callable[[PigeonHoleMessage], Awaitable[None]] = None,
                  cover_fn: Callable[[None], PigeonHoleMessage] = None,
-                 event_loop: AbstractEventLoop = None
+                 event_loop: AbstractEventLoop = None,
+                 session: Optional[ClientSession] = None
         ):
         self.base_url = base_url
+        self.session = session
+        self._ph_url = base_url.join(URL('/ph/'))
         self.queue = Queue()
         self._stop_asked = False
         self.send_fn = self._default_send_fn if send_fn is None else send_fn
@@ -66,9 +83,7 @@ class QueueMessageSender(MessageSender):
                 await self.send_fn(self.cover_fn())
 
     async def _default_send_fn(self, message: PigeonHoleMessage):
-        async with ClientSession() as session:
-            async with session.post(self.base_url.join(URL(f'/ph/{message.address.hex()}')), data=message.to_bytes()) as http_response:
-                http_response.raise_for_status()
+        await post_message(self._ph_url, message, self.session)
 
     def _default_cover_fn(self):
         return PigeonHoleMessage(gen_fake_address(), gen_fake_encrypted_message(PH_MESSAGE_LENGTH))
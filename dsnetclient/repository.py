@@ -1,9 +1,10 @@
 import abc
 import datetime
 import sqlite3
+import time
 from collections import defaultdict
 from operator import attrgetter
-from typing import List, Mapping, Optional
+from typing import AsyncContextManager, List, Mapping, Optional
 
 from cryptography.hazmat.primitives._serialization import Encoding, PrivateFormat, NoEncryption
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
@@ -21,6 +22,8 @@ from sqlalchemy.sql.expression import func
 from dsnetclient.models import pigeonhole_table, conversation_table, message_table, peer_table, serverkey_table, \
     token_table, parameter_table, publication_table, publication_message_table
 
+PEERS_CACHE_SECONDS = 60
+
 
 class Peer:
     def __init__(self, public_key: bytes, id=None):
@@ -40,6 +43,14 @@ class Publication:
 
 class Repository(metaclass=abc.ABCMeta):
 
+    @abc.abstractmethod
+    def transaction(self) -> AsyncContextManager:
+        """
+        Opens a transaction: the repository calls awaited inside it are committed together
+
+        :return: async context manager of the transaction
+        """
+
     @abc.abstractmethod
     async def get_conversations_filter_by(self, **kwargs) -> List[Conversation]:
         """
@@ -58,6 +69,15 @@ class Repository(metaclass=abc.ABCMeta):
         :return: Conversation if found
         """
 
+    @abc.abstractmethod
+    async def get_messages(self, conversation_id: int) -> Optional[List[PigeonHoleMessage]]:
+        """
+        Get the messages of a conversation without loading the conversation and its pigeonholes
+
+        :param conversation_id: conversation id
+        :return: messages ordered by timestamp, None if there is no such conversation
+        """
+
     @abc.abstractmethod
     async def get_conversation_by_key(self, conversation_pub_key: bytes) -> Optional[Conversation]:
         """
@@ -85,6 +105,14 @@ class Repository(metaclass=abc.ABCMeta):
         :return: True if conversation is saved, else False
         """
 
+    @abc.abstractmethod
+    async def save_conversations(self, conversations: List[Conversation]) -> None:
+        """
+        Saves a list of conversations in one batch.
+
+        :param conversations: Conversations to save
+        """
+
     @abc.abstractmethod
     async def delete_pigeonhole(self, address: bytes) -> bool:
         """
@@ -143,6 +171,12 @@ class Repository(metaclass=abc.ABCMeta):
         Save peer
         """
 
+    @abc.abstractmethod
+    async def save_peers(self, peers: List[Peer]) -> None:
+        """
+        Save peers in one batch, ignoring the ones already saved
+        """
+
     @abc.abstractmethod
     async def get_pigeonholes_by_adr(self, adr: str) -> List[PigeonHole]:
         """
@@ -171,7 +205,7 @@ class Repository(metaclass=abc.ABCMeta):
     async def save_tokens(self, tokens: List[AbeToken]) -> int:
         """
         Save query tokens
-        :return: True if saved else False
+        :return: number of saved tokens
         """
 
     @abc.abstractmethod
@@ -188,6 +222,13 @@ class Repository(metaclass=abc.ABCMeta):
         :return: list of token binary
         """
 
+    @abc.abstractmethod
+    async def get_packed_tokens(self) -> List[bytes]:
+        """
+        show stored tokens as they are stored, without decoding them
+        :return: list of packb encoded tokens
+        """
+
     @abc.abstractmethod
     async def get_last_broadcast_timestamp(self) -> datetime.datetime:
         """
@@ -241,6 +282,11 @@ class Repository(metaclass=abc.ABCMeta):
 class SqlalchemyRepository(Repository):
     def __init__(self, database: Database):
         self.database = database
+        self._peers: Optional[List[Peer]] = None
+        self._peers_ts = 0.0
+
+    def transaction(self) -> AsyncContextManager:
+        return self.database.transaction()
 
     async def get_last_broadcast_timestamp(self) -> Optional[datetime.datetime]:
         stmt = select(func.max(message_table.c.timestamp)).select_from(message_table)
@@ -267,6 +313,18 @@ class SqlalchemyRepository(Repository):
             conversation_id=row['conversation_id'],
         )
 
+    @staticmethod
+    def _message_from_row(row, address_column: str = 'address', conversation_id_column: str = 'conversation_id') -> PigeonHoleMessage:
+        # column names differ when the message table is joined with the conversation and pigeonhole tables
+        return PigeonHoleMessage(
+            address=row[address_column],
+            payload=row['payload'],
+            from_key=row['from_key'],
+            timestamp=row['timestamp'],
+            conversation_id=row[conversation_id_column],
+            msg_type=MessageType(row['type'])
+        )
+
     async def get_pigeonholes(self) -> List[PigeonHole]:
         return [SqlalchemyRepository._pigeonhole_from_row(row)
                 for row in await self.database.fetch_all(pigeonhole_table.select())]
@@ -275,6 +333,14 @@ class SqlalchemyRepository(Repository):
         stmt = self._create_conversation_statement().where(conversation_table.c.id == id)
         return await self.get_one_conversation(stmt)
 
+    async def get_messages(self, conversation_id: int) -> Optional[List[PigeonHoleMessage]]:
+        stmt = message_table.select().where(message_table.c.conversation_id == conversation_id).order_by(message_table.c.timestamp)
+        rows = await self.database.fetch_all(stmt)
+        if not rows:
+            exists = await self.database.fetch_one(select(conversation_table.c.id).where(conversation_table.c.id == conversation_id))
+            return None if exists is None else []
+        return [SqlalchemyRepository._message_from_row(row) for row in rows]
+
     async def get_pigeonholes_by_adr(self, adr_hex: str) -> List[PigeonHole]:
         stmt = pigeonhole_table.select().where(pigeonhole_table.c.adr_hex == adr_hex)
         rows = await self.database.fetch_all(stmt)
@@ -291,15 +357,7 @@ class SqlalchemyRepository(Repository):
 
     async def save_pigeonhole(self, pigeonhole: PigeonHole, conversation_id: int) -> None:
         try:
-            await self.database.execute(insert(pigeonhole_table).values(
-                address=pigeonhole.address,
-                adr_hex=PigeonHoleNotification.from_address(pigeonhole.address).adr_hex,
-                dh_key=pigeonhole.dh_key,
-                key_for_hash=pigeonhole.key_for_hash,
-                message_number=pigeonhole.message_number,
-                conversation_id=conversation_id
-            )
-            )
+            await self.database.execute(insert(pigeonhole_table).values(self._pigeonhole_values(pigeonhole, conversation_id)))
         except sqlite3.IntegrityError:
             logger.debug("Attempted to add an existing pigeonhole")
 
@@ -310,15 +368,7 @@ class SqlalchemyRepository(Repository):
         async with self.database.transaction():
             if conversation.id is None:
                 conversation_id = await self.database.execute(
-                    insert(conversation_table).values(
-                        secret_key=conversation.secret_key,
-                        public_key=conversation.public_key,
-                        other_public_key=conversation.other_public_key,
-                        querier=conversation.querier,
-                        created_at=conversation.created_at,
-                        query=conversation.query,
-                        query_mspsi_secret=None if conversation.query_mspsi_secret is None else conversation.query_mspsi_secret.binary()
-                    )
+                    insert(conversation_table).values(self._conversation_values(conversation))
                 )
             else:
                 conversation_id = conversation.id
@@ -337,20 +387,64 @@ class SqlalchemyRepository(Repository):
             for msg in conversation._messages:
                 await self._save_message(msg, conversation_id)
 
+    async def save_conversations(self, conversations: List[Conversation]) -> None:
+        async with self.database.transaction():
+            pigeonholes = list()
+            messages = list()
+            for conversation in conversations:
+                if conversation.id is not None:
+                    await self.save_conversation(conversation)
+                    continue
+                conversation_id = await self.database.execute(
+                    insert(conversation_table).values(self._conversation_values(conversation))
+                )
+                pigeonholes.extend(self._pigeonhole_values(ph, conversation_id) for ph in conversation._pigeonholes.values())
+                messages.extend(self._message_values(msg, conversation_id) for msg in conversation._messages)
+            if pigeonholes:
+                await self.database.execute_many(insert(pigeonhole_table), pigeonholes)
+            if messages:
+                await self.database.execute_many(insert(message_table), messages)
+
     async def _save_message(self, message: PigeonHoleMessage, conversation_id: int) -> None:
         try:
-            stmt = insert(message_table).values(
-                address=message.address,
-                from_key=message.from_key,
-                payload=message.payload,
-                timestamp=message.timestamp,
-                conversation_id=conversation_id,
-                type=message.type()
-            )
-            await self.database.execute(stmt)
+            await self.database.execute(insert(message_table).values(self._message_values(message, conversation_id)))
         except sqlite3.IntegrityError:
             logger.debug("Attempted to save an existing message")
 
+    @staticmethod
+    def _conversation_values(conversation: Conversation) -> dict:
+        return {
+            "secret_key": conversation.secret_key,
+            "public_key": conversation.public_key,
+            "other_public_key": conversation.other_public_key,
+            "querier": conversation.querier,
+            "created_at": conversation.created_at,
+            "query": conversation.query,
+            "query_mspsi_secret": None if conversation.query_mspsi_secret is None else conversation.query_mspsi_secret.binary()
+        }
+
+    @staticmethod
+    def _pigeonhole_values(pigeonhole: PigeonHole, conversation_id: int) -> dict:
+        return {
+            "address": pigeonhole.address,
+            "adr_hex": PigeonHoleNotification.from_address(pigeonhole.address).adr_hex,
+            "dh_key": pigeonhole.dh_key,
+            "key_for_hash": pigeonhole.key_for_hash,
+            "message_number": pigeonhole.message_number,
+            "conversation_id": conversation_id
+        }
+
+    @staticmethod
+    def _message_values(message: PigeonHoleMessage, conversation_id: int) -> dict:
+        return {
+            "address": message.address,
+            "from_key": message.from_key,
+            "payload": message.payload,
+            "timestamp": message.timestamp,
+            "conversation_id": conversation_id,
+            "type": message.type()
+        }
+
     async def get_conversation_by_key(self, public_key) -> Optional[Conversation]:
         stmt = self._create_conversation_statement().where(conversation_table.c.public_key == public_key)
         return await self.get_one_conversation(stmt)
@@ -399,14 +493,7 @@ class SqlalchemyRepository(Repository):
                     key_for_hash=row['key_for_hash'],
                     conversation_id=row['id'],
                 )
-            messages_dict[row['id']][row['address_1']] = PigeonHoleMessage(
-                address=row['address_1'],
-                payload=row['payload'],
-                from_key=row['from_key'],
-                timestamp=row['timestamp'],
-                conversation_id=row['id'],
-                msg_type=MessageType(row['type'])
-            )
+            messages_dict[row['id']][row['address_1']] = SqlalchemyRepository._message_from_row(row, 'address_1', 'id')
         return [
             Conversation(
                 c.secret_key,
@@ -424,14 +511,28 @@ class SqlalchemyRepository(Repository):
         ]
 
     async def peers(self) -> List[Peer]:
-        stmt = peer_table.select()
-        return [Peer(**peer) for peer in await self.database.fetch_all(stmt)]
+        """
+        peers are read for each query so they are cached. save_peer(s) clears the cache at once,
+        peers written by another process or repository instance are seen after PEERS_CACHE_SECONDS
+        """
+        if self._peers is None or time.monotonic() - self._peers_ts >= PEERS_CACHE_SECONDS:
+            stmt = peer_table.select()
+            self._peers = [Peer(**peer) for peer in await self.database.fetch_all(stmt)]
+            self._peers_ts = time.monotonic()
+        return list(self._peers)
 
     async def save_peer(self, peer: Peer):
         try:
             await self.database.execute(insert(peer_table).values(public_key=peer.public_key))
         except sqlite3.IntegrityError:
             logger.debug("Attempted to save an existing peer")
+        self._peers = None
+
+    async def save_peers(self, peers: List[Peer]) -> None:
+        if peers:
+            stmt = insert(peer_table).prefix_with("OR IGNORE", dialect="sqlite")
+            await self.database.execute_many(stmt, [{"public_key": peer.public_key} for peer in peers])
+        self._peers = None
 
     async def save_token_server_key(self, public_key: AbePublicKey) -> bool:
         stmt = insert(serverkey_table).values(
@@ -447,15 +548,17 @@ class SqlalchemyRepository(Repository):
         return unpackb(row['master_key']) if row else None
 
     async def save_tokens(self, tokens: List[AbeToken]) -> int:
+        timestamp = datetime.datetime.utcnow()
         data = [
             {
                 "token": packb(abe_token.token),
                 "secret_key": abe_token.secret_key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption()),
-                "timestamp": datetime.datetime.utcnow()
+                "timestamp": timestamp
             } for abe_token in tokens
         ]
-        stmt = insert(token_table).values(data)
-        return await self.database.execute(stmt)
+        async with self.database.transaction():
+            await self.database.execute_many(insert(token_table), data)
+        return len(data)
 
     async def pop_token(self) -> Optional[AbeToken]:
         async with self.database.transaction():
@@ -471,6 +574,9 @@ class SqlalchemyRepository(Repository):
         return [AbeToken(Ed25519PrivateKey.from_private_bytes(r['secret_key']), unpackb(r['token']))
                 for r in await self.database.fetch_all(token_table.select())]
 
+    async def get_packed_tokens(self) -> List[bytes]:
+        return [r['token'] for r in await self.database.fetch_all(select(token_table.c.token))]
+
     async def set_parameter(self, key, value):
         stmt = insert(parameter_table).values({'key': key, 'value': value})
         return await self.database.execute(stmt)
@@ -4,6 +4,7 @@ import re
 import databases
 import pytest
 import pytest_asyncio
+from aiohttp import ClientSession
 from cuckoo.filter import BCuckooFilter
 from dsnet.core import QueryType
 from dsnet.crypto import gen_key_pair
@@ -52,6 +53,7 @@ async def test_send_query_no_tokens(httpserver: HTTPServer, connect_disconnect_d
 
     with pytest.raises(NoTokenException):
         await api.send_query(b'raw query')
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -65,6 +67,7 @@ async def test_send_query(httpserver: HTTPServer, connect_disconnect_db):
     conversations = await api.repository.get_conversations()
     assert len(conversations) == 2
     assert conversations[0].query == b'raw query'
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -79,6 +82,7 @@ async def test_send_publication(httpserver: HTTPServer, memory_index: MemoryInde
     assert len(publications) == 1
     assert publications[0].nb_docs == 1
     assert publications[0].nym == await api.repository.get_parameter("nym")
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -92,6 +96,7 @@ async def test_send_response(httpserver: HTTPServer, connect_disconnect_db):
     conversations = await api.repository.get_conversations()
     assert len(conversations) == 1
     assert conversations[0].nb_sent_messages == 1
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -106,6 +111,7 @@ async def test_receive_query_matches(httpserver: HTTPServer, memory_index: Memor
     conversations = await api.repository.get_conversations()
     assert len(conversations) == 1
     assert conversations[0].nb_sent_messages == 1
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -119,6 +125,7 @@ async def test_receive_query_does_not_match(httpserver: HTTPServer, connect_disc
     httpserver.check()
     conv = (await api.repository.get_conversations())[0]
     assert conv.last_message.payload == b"[]"
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -133,6 +140,7 @@ async def test_receive_query_wrong_signature(httpserver: HTTPServer, memory_inde
     httpserver.check()
     conversations = await api.repository.get_conversations()
     assert len(conversations) == 0
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -147,6 +155,7 @@ async def test_do_treat_my_own_query(httpserver: HTTPServer, memory_index: Memor
     assert len(conversations) == 2
     assert conversations[0].nb_sent_messages == 1
     assert conversations[1].nb_sent_messages == 1
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -154,6 +163,7 @@ async def test_receive_ph_notification_no_listening_address(httpserver: HTTPServ
     httpserver.respond_permanent_failure()
     api = await create_api(httpserver)
     await api.handle_ph_notification(PigeonHoleNotification('beef')) # if server is called it will break
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -172,6 +182,7 @@ async def test_receive_ph_notification_with_matching_address_as_querier(httpserv
     assert len(conversations) == 2
     assert conversations[0].nb_sent_messages == 1
     assert conversations[0].nb_recv_messages == 1
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -191,6 +202,7 @@ async def test_receive_ph_notification_with_matching_address_as_recipient(httpse
     assert len(conversations) == 1
     assert conversations[0].nb_sent_messages == 1
     assert conversations[0].nb_recv_messages == 2
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -207,6 +219,7 @@ async def test_send_message(httpserver: HTTPServer, connect_disconnect_db):
     assert len(conversations) == 2
     assert conversations[0].nb_sent_messages == 2
     assert conversations[0].nb_recv_messages == 0
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -215,6 +228,7 @@ async def test_get_broadcast_recovery_timestamp(httpserver: HTTPServer, connect_
     ts = await api.broadcast_recovery_timestamp()
     assert isinstance(ts, datetime.datetime)
     assert ts < datetime.datetime.utcnow()
+    await api.close()
 
 
 @pytest.mark.asyncio
@@ -226,6 +240,45 @@ async def test_get_broadcast_recovery_timestamp_from_last_message(httpserver: HT
     actual_ts = await api.broadcast_recovery_timestamp()
 
     assert expected_ts == actual_ts
+    await api.close()
+
+
+def test_reconnect_delay_is_exponential_capped_and_jittered():
+    api = DsnetApi(URL('http://notused'), None, None, secret_key=b'', message_retriever=None, message_sender=None,
+                   query_type=QueryType.CLEARTEXT, reconnect_delay_seconds=2, max_reconnect_delay_seconds=60)
+
+    assert 1.5 <= api.reconnect_delay(0) <= 2.5
+    assert 6 <= api.reconnect_delay(2) <= 10
+    assert 45 <= api.reconnect_delay(1000) <= 75
+
+
+@pytest.mark.asyncio
+async def test_get_token_server_key_is_cached(httpserver: HTTPServer, connect_disconnect_db):
+    api = await create_api(httpserver)
+    server_key = await api.get_token_server_key()
+    _, other_server_key = create_tokens(1)
+    await api.repository.save_token_server_key(other_server_key)
+
+    assert await api.get_token_server_key() == server_key
+    await api.close()
+
+
+@pytest.mark.asyncio
+async def test_close_does_not_close_caller_session():
+    async with ClientSession() as session:
+        api = DsnetApi(URL('http://notused'), None, None, secret_key=b'', message_retriever=None, message_sender=None,
+                       query_type=QueryType.CLEARTEXT, session=session)
+        await api.close()
+        assert not session.closed
+
+
+@pytest.mark.asyncio
+async def test_close_closes_own_session():
+    api = DsnetApi(URL('http://notused'), None, None, secret_key=b'', message_retriever=None, message_sender=None,
+                   query_type=QueryType.CLEARTEXT)
+    own_session = api.session
+    await api.close()
+    assert own_session.closed
 
 
 async def create_api(httpserver, index=None, number_tokens=3):
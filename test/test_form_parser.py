@@ -0,0 +1,27 @@
+from dsnetclient.form_parser import bs_parser
+
+
+def test_bs_parser_login_form():
+    html = b'''<html><body>
+    <h1>Login</h1>
+    <form action="/login" method="post">
+        <input type="hidden" name="csrf" value="token"/>
+        <input type="text" name="username"/>
+        <input type="password" name="password"/>
+        <input type="submit" value="Sign in"/>
+    </form>
+    </body></html>'''
+
+    assert bs_parser(html, 'johndoe', 'secret') == ('/login', {'csrf': 'token', 'username': 'johndoe', 'password': 'secret'})
+
+
+def test_bs_parser_form_without_action():
+    html = b'<form method="post"><input type="text" name="user"/><input type="password" name="pw"/></form>'
+
+    assert bs_parser(html, 'johndoe', 'secret') == (None, {'user': 'johndoe', 'pw': 'secret'})
+
+
+def test_bs_parser_input_types_are_case_insensitive():
+    html = b'<form action="/login"><input type="Text" name="user"/><input type="PASSWORD" name="pw"/></form>'
+
+    assert bs_parser(html, 'johndoe', 'secret') == ('/login', {'user': 'johndoe', 'pw': 'secret'})
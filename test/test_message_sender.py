@@ -6,7 +6,7 @@ import pytest
 from yarl import URL
 from dsnet.message import PigeonHoleMessage
 
-from dsnetclient.message_sender import QueueMessageSender
+from dsnetclient.message_sender import QueueMessageSender, message_url
 
 
 def const_distribution() -> float:
@@ -50,3 +50,8 @@ async def test_server_called_with_distribution_fn_sleep():
 
     assert send_fn.call_count == 2
     assert asyncio.get_running_loop().time() - start == 8.0
+
+
+def test_message_url():
+    message = PigeonHoleMessage(b'\xbe\xef', b'payload', b'from_key')
+    assert message_url(URL('http://dsnet:8000/ph/'), message) == URL('http://dsnet:8000/ph/beef')
@@ -10,9 +10,10 @@ from dsnet.message import PigeonHoleMessage, PigeonHoleNotification, Publication
 from dsnet.mspsi import MSPSIQuerier, CUCKOO_FILTER_ERROR_RATE, CUCKOO_FILTER_BUCKET_SIZE, CUCKOO_FILTER_MAX_KICKS
 from petlib.bn import Bn
 from sqlalchemy import create_engine
-from sscred import AbeParam
+from sscred import AbeParam, packb
 
-from dsnetclient.models import metadata
+import dsnetclient.repository
+from dsnetclient.models import metadata, message_table
 from dsnetclient.repository import SqlalchemyRepository, Peer, Publication
 from test.test_utils import create_tokens
 
@@ -141,6 +142,25 @@ async def test_save_conversation_with_messages(connect_disconnect_db):
     assert actual_conversation._messages[3].type() == MessageType.RESPONSE
 
 
+@pytest.mark.asyncio
+async def test_save_conversations(connect_disconnect_db):
+    query_keys = gen_key_pair()
+    conversations = [
+        Conversation.create_from_querier(query_keys.secret, gen_key_pair().public, query=b'France'),
+        Conversation.create_from_querier(query_keys.secret, gen_key_pair().public, query=b'France'),
+    ]
+
+    repository = SqlalchemyRepository(database)
+    await repository.save_conversations(conversations)
+
+    actual_conversations = await repository.get_conversations()
+    assert len(actual_conversations) == 2
+    assert {c.other_public_key for c in actual_conversations} == {c.other_public_key for c in conversations}
+    assert all(c.last_message.type() == MessageType.QUERY for c in actual_conversations)
+    for conversation in conversations:
+        assert await repository.get_pigeonhole(conversation.last_address) is not None
+
+
 @pytest.mark.asyncio
 async def test_get_conversation_by_key_no_records(connect_disconnect_db):
     assert await SqlalchemyRepository(database).get_conversation_by_key(b'unknown') is None
@@ -259,6 +279,28 @@ async def test_save_conversation_deletes_old_pigeonholes(connect_disconnect_db):
     assert ts != await repository.get_last_broadcast_timestamp()
 
 
+@pytest.mark.asyncio
+async def test_get_messages(connect_disconnect_db):
+    query_keys = gen_key_pair()
+    carol_keys = gen_key_pair()
+    carol_side = Conversation.create_from_recipient(carol_keys.secret, query_keys.public)
+    querier_side = Conversation.create_from_querier(query_keys.secret, carol_keys.public, query=b'Hello')
+    querier_side.add_message(carol_side.create_response(b"Hi"))
+
+    repository = SqlalchemyRepository(database)
+    await repository.save_conversation(querier_side)
+
+    conversation = (await repository.get_conversations())[0]
+    messages = await repository.get_messages(conversation.id)
+    assert [m.payload for m in messages] == [m.payload for m in conversation._messages]
+    assert messages[0].type() == MessageType.QUERY
+    assert messages[1].payload == b'Hi'
+    assert await repository.get_messages(conversation.id + 1) is None
+
+    await database.execute(message_table.delete())
+    assert await repository.get_messages(conversation.id) == []
+
+
 @pytest.mark.asyncio
 async def test_save_get_peers(connect_disconnect_db):
     peer_keys = gen_key_pair()
@@ -279,6 +321,40 @@ async def test_save_peers_twice(connect_disconnect_db):
     assert len(await repository.peers()) == 1
 
 
+@pytest.mark.asyncio
+async def test_save_peer_after_get_peers(connect_disconnect_db):
+    repository = SqlalchemyRepository(database)
+    await repository.save_peer(Peer(gen_key_pair().public))
+    assert len(await repository.peers()) == 1
+
+    await repository.save_peer(Peer(gen_key_pair().public))
+    assert len(await repository.peers()) == 2
+
+
+@pytest.mark.asyncio
+async def test_peers_written_by_another_repository(connect_disconnect_db, monkeypatch):
+    repository = SqlalchemyRepository(database)
+    other_repository = SqlalchemyRepository(database)
+    assert await repository.peers() == []
+
+    await other_repository.save_peer(Peer(gen_key_pair().public))
+    assert await repository.peers() == []
+
+    monkeypatch.setattr(dsnetclient.repository, "PEERS_CACHE_SECONDS", 0)
+    assert len(await repository.peers()) == 1
+
+
+@pytest.mark.asyncio
+async def test_save_peers(connect_disconnect_db):
+    repository = SqlalchemyRepository(database)
+    existing_key = gen_key_pair().public
+    await repository.save_peer(Peer(existing_key))
+    assert len(await repository.peers()) == 1
+
+    await repository.save_peers([Peer(existing_key), Peer(gen_key_pair().public)])
+    assert len(await repository.peers()) == 2
+
+
 @pytest.mark.asyncio
 async def test_save_token_server_key(connect_disconnect_db):
     repository = SqlalchemyRepository(database)
@@ -311,6 +387,15 @@ async def test_get_tokens(connect_disconnect_db):
     assert await repository.get_tokens() == tokens
 
 
+@pytest.mark.asyncio
+async def test_get_packed_tokens(connect_disconnect_db):
+    repository = SqlalchemyRepository(database)
+    tokens, _ = create_tokens(3)
+
+    await repository.save_tokens(tokens)
+    assert await repository.get_packed_tokens() == [packb(t.token) for t in tokens]
+
+
 @pytest.mark.asyncio
 async def test_set_get_parameter(connect_disconnect_db):
     repository = SqlalchemyRepository(database)